@@ -4,16 +4,20 @@ setup(
     name='playlist_scraper',
     version='0.1.0',
     packages=find_packages(),
+    python_requires='>=3.10',  # anext()
     include_package_data=True,
     install_requires=[
         'fastapi',
-        'uvicorn',
-        'requests',
+        'uvicorn[standard]',  # uvloop and httptools for run()
+        'httpx[http2,brotli]',
+        'redis>=5.0.1',  # Redis.from_pool, aclose()
+        'orjson',
         'python-dotenv',  # Added to handle environment variables
     ],
     entry_points={
         'console_scripts': [
-            'playlist_scraper = src.api:run',
+            'playlist_scraper = src.cli:run',
+            'playlist_scraper-dev = src.cli:run_dev',
         ],
     },
 )
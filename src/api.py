@@ -1,27 +1,106 @@
-from fastapi import FastAPI, HTTPException, Query
-from starlette.responses import RedirectResponse
-from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from starlette.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
+import httpx
+import orjson
+import redis.asyncio as redis
+from src.middleware import CORSHeaderMiddleware
 from src.scraper import SpotifyDataFetcher
-from dotenv import load_dotenv
+import json
 import os
+import secrets
 
-load_dotenv()
+# Read when the module is imported; the src.cli entry points load .env before uvicorn imports it
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-REDIRECT_URI = "http://localhost:5510/callback"
+# Must match a redirect URI registered for the Spotify app
+REDIRECT_URI = os.getenv("REDIRECT_URI", "http://localhost:5510/callback")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Origin allowed to call the API from a browser; leave unset when CORS is handled by a proxy
+CORS_ALLOW_ORIGIN = os.getenv("CORS_ALLOW_ORIGIN")
+
+# How long a user has to finish the Spotify consent screen
+OAUTH_STATE_TTL = 600
+# Sessions outlive the hour-long access token; the refresh token keeps them usable
+SESSION_TTL = 30 * 24 * 3600
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for the whole process, so Spotify calls reuse connections.
+    # Keep enough idle connections around that a playlist fan-out doesn't have
+    # to reconnect (DNS + TLS) on the next request. httpx asks for gzip, and for br as
+    # well when brotli is installed (the httpx[brotli] extra).
+    app.state.http = httpx.AsyncClient(
+        base_url="https://api.spotify.com",
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=200,
+            max_keepalive_connections=100,
+            keepalive_expiry=300,
+        ),
+        timeout=10.0,
+    )
+    # OAuth state and session tokens live in Redis so any worker can serve any user.
+    # A blocking pool makes bursts wait for a free connection instead of failing.
+    app.state.redis = redis.Redis.from_pool(
+        redis.BlockingConnectionPool.from_url(REDIS_URL, decode_responses=True, max_connections=100, timeout=10)
+    )
+    yield
+    await app.state.http.aclose()
+    await app.state.redis.aclose()
+
+
+app = FastAPI(title="PlaylistScraper", lifespan=lifespan)
+if CORS_ALLOW_ORIGIN:
+    app.add_middleware(CORSHeaderMiddleware, allow_origin=CORS_ALLOW_ORIGIN)
+
+
+@app.exception_handler(httpx.HTTPStatusError)
+async def spotify_error_handler(request: Request, exc: httpx.HTTPStatusError):
+    # A Spotify request failed even after retries: pass rate limits through, report outages as 502
+    status_code = exc.response.status_code
+    headers = None
+    if status_code == 429:
+        retry_after = exc.response.headers.get("Retry-After")
+        headers = {"Retry-After": retry_after} if retry_after else None
+    elif status_code >= 500:
+        status_code = 502
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": f"Spotify request failed with status {exc.response.status_code}"},
+        headers=headers,
+    )
 
-app = FastAPI(title="PlaylistScraper")
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-# Initialize the SpotifyDataFetcher instance (without a user_id for now)
-spotify_fetcher = SpotifyDataFetcher(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
+# Dependency to ensure the user is authenticated
+async def get_spotify_fetcher(request: Request, session_id: str = Query(...)):
+    session = await request.app.state.redis.get(f"session:{session_id}")
+    if not session:
+        raise HTTPException(status_code=401, detail="User is not authenticated")
+
+    session = json.loads(session)
+    spotify_fetcher = SpotifyDataFetcher(
+        CLIENT_ID, CLIENT_SECRET, REDIRECT_URI,
+        http=request.app.state.http,
+        cache=request.app.state.redis,
+        user_id=session["user_id"],
+    )
+    spotify_fetcher.load_token_info(session)
+    # Refresh up front, so a revoked refresh token ends the session instead of failing the route
+    try:
+        await spotify_fetcher.ensure_token()
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code not in (400, 401):
+            raise
+        await request.app.state.redis.delete(f"session:{session_id}")
+        raise HTTPException(status_code=401, detail="Session has expired, please log in again")
+    yield spotify_fetcher
+
+    # Save a token refreshed during the request so the next request doesn't refresh it again
+    if spotify_fetcher.access_token != session["access_token"]:
+        session.update(spotify_fetcher.token_info)
+        await request.app.state.redis.setex(f"session:{session_id}", SESSION_TTL, json.dumps(session))
 
 
 @app.get("/")
@@ -30,81 +109,84 @@ def read_root():
 
 
 @app.get("/user-profile")
-def get_user_profile():
-    if not spotify_fetcher.access_token:
-        raise HTTPException(status_code=401, detail="User is not authenticated")
-    try:
-        spotify_fetcher.fetch_user_profile()
-        return spotify_fetcher.user_profile
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+async def get_user_profile(spotify_fetcher: SpotifyDataFetcher = Depends(get_spotify_fetcher)):
+    return await spotify_fetcher.fetch_user_profile()
 
 @app.get("/login")
-def login():
+async def login(request: Request):
     # Define the required scopes
     scopes = ["user-top-read", "playlist-read-private"]
+    # Remember the state so the callback can be verified by whichever worker receives it
+    state = secrets.token_urlsafe(16)
+    await request.app.state.redis.setex(
+        f"oauth:state:{state}", OAUTH_STATE_TTL, json.dumps({"client_id": CLIENT_ID})
+    )
     # Generate the authorization URL
-    auth_url = spotify_fetcher.get_auth_url(scopes)
+    spotify_fetcher = SpotifyDataFetcher(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
+    auth_url = spotify_fetcher.get_auth_url(scopes, state=state)
     # Redirect the user to the authorization URL
     return RedirectResponse(url=auth_url)
 
 
 @app.get("/callback")
-def callback(code: str = Query(None)):
+async def callback(request: Request, code: str = Query(None), state: str = Query(None)):
     if not code:
         raise HTTPException(status_code=400, detail="Missing code parameter")
+    if not state or not await request.app.state.redis.getdel(f"oauth:state:{state}"):
+        raise HTTPException(status_code=400, detail="Invalid or expired state parameter")
 
     # Exchange the code for an access token
-    spotify_fetcher.exchange_code_for_token(code)
-    return {"message": "Authentication successful. You can now use the API endpoints."}
+    spotify_fetcher = SpotifyDataFetcher(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, http=request.app.state.http)
+    try:
+        token_info = await spotify_fetcher.exchange_code_for_token(code)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code not in (400, 401):
+            raise
+        raise HTTPException(status_code=400, detail="Invalid or expired authorization code")
+    # Responses are cached per Spotify user, so several sessions of one user share them
+    profile = await spotify_fetcher.fetch_user_profile()
+    session = {**token_info, "user_id": profile["id"]}
+    # The state was visible to whoever started /login, so the session gets its own secret id
+    session_id = secrets.token_urlsafe(32)
+    await request.app.state.redis.setex(f"session:{session_id}", SESSION_TTL, json.dumps(session))
+    return {
+        "message": "Authentication successful. You can now use the API endpoints.",
+        "session_id": session_id,
+    }
 
 
 @app.get("/top-artists")
-def top_artists():
-    if not spotify_fetcher.access_token:
-        raise HTTPException(status_code=401, detail="User is not authenticated")
-
-    spotify_fetcher.fetch_user_top_artists()
-    return spotify_fetcher.user_top_artists
+async def top_artists(spotify_fetcher: SpotifyDataFetcher = Depends(get_spotify_fetcher)):
+    return await spotify_fetcher.fetch_user_top_artists()
 
 
 @app.get("/top-tracks")
-def top_tracks():
-    if not spotify_fetcher.access_token:
-        raise HTTPException(status_code=401, detail="User is not authenticated")
-
-    spotify_fetcher.fetch_user_top_tracks()
-    return spotify_fetcher.user_top_tracks
+async def top_tracks(spotify_fetcher: SpotifyDataFetcher = Depends(get_spotify_fetcher)):
+    return await spotify_fetcher.fetch_user_top_tracks()
 
 
 @app.get("/playlists")
-def playlists():
-    if not spotify_fetcher.access_token:
-        raise HTTPException(status_code=401, detail="User is not authenticated")
-
-    spotify_fetcher.fetch_user_playlists()
-    return spotify_fetcher.user_playlists
+async def playlists(spotify_fetcher: SpotifyDataFetcher = Depends(get_spotify_fetcher)):
+    return await spotify_fetcher.fetch_user_playlists()
 
 
-# Dependency to ensure the user is authenticated
-def get_current_authenticated_user():
-    if not spotify_fetcher.access_token:
-        raise HTTPException(status_code=401, detail="User is not authenticated")
-    return spotify_fetcher
-
+@app.get("/playlist-items")
+async def playlist_items(
+    playlist_id: str = Query(...),
+    spotify_fetcher: SpotifyDataFetcher = Depends(get_spotify_fetcher),
+):
+    items = spotify_fetcher.fetch_playlist_items(playlist_id)
+    # Wait for the first page before the 200 goes out, so Spotify errors still get a proper status
+    try:
+        first_item = await anext(items)
+    except StopAsyncIteration:
+        return Response(media_type="application/x-ndjson")
 
-# Endpoint to fetch details for a specific playlist
-# @app.get("/playlists/{playlist_id}")
-# def playlist_details(playlist_id: str)):
-#     playlist = user.user_playlists.get(playlist_id)
-#     if not playlist:
-#         # If we do not have the playlist cached, fetch it again
-#         user.fetch_user_playlists()
-#         playlist = user.user_playlists.get(playlist_id)
-#         if not playlist:
-#             raise HTTPException(status_code=404, detail="Playlist not found")
-#     return user.fetch_playlist_details(playlist)
+    # One JSON object per line, written as each page of the playlist comes in
+    async def lines():
+        yield orjson.dumps(first_item) + b"\n"
+        async for item in items:
+            yield orjson.dumps(item) + b"\n"
 
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-def run():
-    uvicorn.run("src.api:app", host="localhost", port=5510, reload=True)
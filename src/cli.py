@@ -0,0 +1,24 @@
+import os
+
+from dotenv import load_dotenv
+import uvicorn
+
+
+def run():
+    # Before uvicorn imports src.api, which reads its configuration at import time
+    load_dotenv()
+    uvicorn.run(
+        "src.api:app",
+        host="0.0.0.0",
+        port=5510,
+        workers=min(4, os.cpu_count() or 1),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+    )
+
+
+def run_dev():
+    # Single worker with auto-reload on code changes; not for production
+    load_dotenv()
+    uvicorn.run("src.api:app", host="localhost", port=5510, reload=True)
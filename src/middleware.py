@@ -0,0 +1,22 @@
+class CORSHeaderMiddleware:
+    """
+    Pure ASGI middleware that adds an Access-Control-Allow-Origin header to HTTP responses.
+    Unlike Starlette's CORSMiddleware it doesn't wrap requests or handle preflights, which
+    the API's simple GET endpoints don't need.
+    """
+
+    def __init__(self, app, allow_origin):
+        self.app = app
+        self.header = (b'access-control-allow-origin', allow_origin.encode('latin-1'))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cors(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), self.header]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
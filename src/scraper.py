@@ -1,25 +1,120 @@
-import requests
+import asyncio
 import base64
+import collections
+import functools
+import itertools
+import random
+import time
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlencode
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import orjson
+
+
+def _call_key(owner, func, args, kwargs):
+    params = orjson.dumps([args, kwargs], option=orjson.OPT_SORT_KEYS).decode()
+    return f"spotify:{owner}:{func.__name__}:{params}"
+
+
+def single_flight(func):
+    """
+    Let concurrent identical calls for the same user share one in-flight call instead of each
+    going to Spotify. Waiters are shielded, so one of them disconnecting doesn't cancel the rest.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        key = _call_key(self.user_id or self.access_token, func, args, kwargs)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(self, *args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+    return wrapper
+
+
+def redis_cache(ttl):
+    """
+    Cache a fetch_* method's result in Redis for `ttl` seconds, keyed by user, method and arguments.
+    Calls go straight to Spotify when the fetcher has no cache or doesn't know its user yet.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            if self.cache is None or self.user_id is None:
+                return await func(self, *args, **kwargs)
+
+            key = _call_key(self.user_id, func, args, kwargs)
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return orjson.loads(cached)
+
+            result = await func(self, *args, **kwargs)
+            await self.cache.setex(key, ttl, orjson.dumps(result))
+            return result
+        return wrapper
+    return decorator
 
 
 class SpotifyDataFetcher:
     AUTH_URL = 'https://accounts.spotify.com/authorize'
     TOKEN_URL = 'https://accounts.spotify.com/api/token'
+    # Largest page size Spotify accepts on its paginated endpoints
+    PAGE_LIMIT = 50
+    # Most pages of one paginated endpoint requested (and held) at once
+    PAGE_CONCURRENCY = 10
+    # Attempts per Spotify request before giving up on 429s and 5xx responses
+    MAX_ATTEMPTS = 5
+    # Longest we'll sleep between attempts; a longer Retry-After fails the request instead
+    MAX_RETRY_DELAY = 30
+    # Refresh the access token when it has less than this many seconds left
+    TOKEN_REFRESH_MARGIN = 60
+    # How long a response body is kept for revalidation with If-None-Match
+    ETAG_TTL = 24 * 3600
+    # Calls currently waiting on Spotify, shared by every fetcher in this process (see single_flight)
+    _inflight = {}
 
-    def __init__(self, client_id, client_secret, redirect_uri):
+    def __init__(self, client_id, client_secret, redirect_uri, http=None, cache=None, user_id=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        # Shared httpx.AsyncClient, owned by the application lifespan
+        self.http = http
+        # Optional redis.asyncio client used by @redis_cache, and the Spotify user it caches for
+        self.cache = cache
+        self.user_id = user_id
+        # The client credentials never change, so encode them once
+        basic_auth = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+        self._token_headers = {
+            'Authorization': f'Basic {basic_auth}',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
         self.access_token = None
         self.refresh_token = None
         self.token_type = None
+        self.token_info = {}
+        self._token_expires_at = None
+        # Held while refreshing, so concurrent requests trigger a single refresh
+        self._refresh_lock = asyncio.Lock()
+        self.user_profile = {}
         self.user_playlists = {}
-        self.user_top_artists = []
-        self.user_top_tracks = []
+        self.user_top_artists = {}
+        self.user_top_tracks = {}
+
+    @property
+    def access_token(self):
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, access_token):
+        # Rebuild the request headers only when the token changes, not on every call
+        self._access_token = access_token
+        self._bearer_headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        } if access_token else None
 
-    def get_auth_url(self, scopes):
+    def get_auth_url(self, scopes, state=None):
         """
         Generates the URL for user authorization.
         """
@@ -30,132 +125,296 @@ class SpotifyDataFetcher:
             'scope': ' '.join(scopes),
             'show_dialog': 'true',
         }
+        if state:
+            params['state'] = state
         url = f"{self.AUTH_URL}?{urlencode(params)}"
         return url
 
-    def exchange_code_for_token(self, code):
+    async def exchange_code_for_token(self, code):
         """
         Exchange the authorization code for an access token.
         """
-        headers = {
-            'Authorization': 'Basic ' + base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode(),
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
         data = {
             'grant_type': 'authorization_code',
             'code': code,
             'redirect_uri': self.redirect_uri,
         }
-        response = requests.post(self.TOKEN_URL, headers=headers, data=data)
-        token_info = response.json()
+        response = await self.http.post(self.TOKEN_URL, headers=self._token_headers, data=data)
+        response.raise_for_status()
+        token_info = orjson.loads(response.content)
+        token_info['expires_at'] = time.time() + token_info['expires_in']
+        self.load_token_info(token_info)
+        return token_info
+
+    def load_token_info(self, token_info):
+        """
+        Restore the tokens from a token response, or from a cached copy of one.
+        """
         self.access_token = token_info['access_token']
-        self.refresh_token = token_info['refresh_token']
+        self.refresh_token = token_info.get('refresh_token', self.refresh_token)
         self.token_type = token_info['token_type']
+        self._token_expires_at = token_info.get('expires_at')
+        self.token_info = {**self.token_info, **token_info}
 
-    def refresh_access_token(self):
+    async def refresh_access_token(self):
         """
         Refresh the access token using the refresh token.
         """
-        headers = {
-            'Authorization': 'Basic ' + base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode(),
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
         data = {
             'grant_type': 'refresh_token',
             'refresh_token': self.refresh_token,
         }
-        response = requests.post(self.TOKEN_URL, headers=headers, data=data)
-        token_info = response.json()
-        self.access_token = token_info['access_token']
-        self.token_type = token_info['token_type']
+        response = await self.http.post(self.TOKEN_URL, headers=self._token_headers, data=data)
+        response.raise_for_status()
+        token_info = orjson.loads(response.content)
+        token_info['expires_at'] = time.time() + token_info['expires_in']
+        self.load_token_info(token_info)
+        return token_info
 
-    def set_headers(self):
+    def _token_expiring(self):
+        if self._token_expires_at is None:
+            return False
+        return self._token_expires_at - time.time() < self.TOKEN_REFRESH_MARGIN
+
+    async def ensure_token(self):
         """
-        Helper method to set the authorization headers for Spotify API requests.
+        Refresh the access token before it expires. Concurrent callers (e.g. a playlist fan-out)
+        wait on the lock and re-check, so only the first one actually refreshes.
         """
-        return {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
+        if not self._token_expiring():
+            return
+        async with self._refresh_lock:
+            if self._token_expiring():
+                await self.refresh_access_token()
+
+    async def _get(self, url, headers=None, **kwargs):
+        """
+        GET a Spotify endpoint, retrying rate-limited (429) and 5xx responses. A 429 waits for as
+        long as Spotify's Retry-After header asks; 5xx responses back off exponentially with jitter.
+        Waits longer than MAX_RETRY_DELAY aren't slept through: the error is raised right away.
+        Pass query parameters as `params` rather than formatting them into `url`, so httpx
+        encodes them once instead of re-parsing a prebuilt query string.
+        """
+        await self.ensure_token()
+        # Merged after ensure_token, which may have replaced the bearer headers
+        headers = {**self._bearer_headers, **headers} if headers else self._bearer_headers
+        for attempt in range(self.MAX_ATTEMPTS):
+            response = await self.http.get(url, headers=headers, **kwargs)
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if not retryable or attempt == self.MAX_ATTEMPTS - 1:
+                break
+
+            if response.status_code == 429:
+                delay = self._retry_after(response, default=2 ** attempt)
+            else:
+                delay = 2 ** attempt + random.uniform(0, 1)
+            if delay > self.MAX_RETRY_DELAY:
+                break
+            await asyncio.sleep(delay)
+
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _retry_after(response, default):
+        """
+        Seconds to wait according to a Retry-After header, which may be a number of seconds or an
+        HTTP date. Falls back to `default` when the header is missing or malformed.
+        """
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return default
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return default
 
-    def fetch_user_top_artists(self, time_range='medium_term'):
+    async def _get_json(self, url, params=None, revalidate=True):
+        """
+        GET a Spotify endpoint and decode its JSON body. With a cache, bodies that carry an ETag are
+        stored and revalidated with If-None-Match, so an unchanged resource costs a bodiless 304.
+        Pass revalidate=False for large bodies that shouldn't be kept in Redis.
+        """
+        if not revalidate or self.cache is None or self.user_id is None:
+            response = await self._get(url, params=params)
+            return orjson.loads(response.content)
+
+        params_key = orjson.dumps(params, option=orjson.OPT_SORT_KEYS).decode()
+        etag_key = f"spotify:{self.user_id}:etag:{url}:{params_key}"
+        cached = await self.cache.hgetall(etag_key)
+        headers = {'If-None-Match': cached['etag']} if cached else None
+
+        response = await self._get(url, headers=headers, params=params)
+        if response.status_code == 304:
+            return orjson.loads(cached['body'])
+
+        etag = response.headers.get('ETag')
+        if etag:
+            async with self.cache.pipeline(transaction=False) as pipe:
+                pipe.hset(etag_key, mapping={'etag': etag, 'body': response.content})
+                pipe.expire(etag_key, self.ETAG_TTL)
+                await pipe.execute()
+        return orjson.loads(response.content)
+
+    async def _iter_paged_items(self, url, params=None, revalidate=True):
+        """
+        Yield every item of a paginated endpoint, page by page. The first page tells us the total;
+        the remaining pages are fetched through a sliding window of at most PAGE_CONCURRENCY
+        requests and yielded in offset order, so only that many pages are ever held in memory.
+        """
+        params = {**(params or {}), 'limit': self.PAGE_LIMIT}
+        first_page = await self._get_json(url, {**params, 'offset': 0}, revalidate)
+        for item in first_page['items']:
+            yield item
+
+        offsets = iter(range(self.PAGE_LIMIT, first_page['total'], self.PAGE_LIMIT))
+        window = collections.deque(
+            asyncio.ensure_future(self._get_json(url, {**params, 'offset': offset}, revalidate))
+            for offset in itertools.islice(offsets, self.PAGE_CONCURRENCY)
+        )
+        try:
+            while window:
+                page = await window.popleft()
+                # Refill the window as each page is handed over
+                for offset in itertools.islice(offsets, 1):
+                    window.append(asyncio.ensure_future(
+                        self._get_json(url, {**params, 'offset': offset}, revalidate)
+                    ))
+                for item in page['items']:
+                    yield item
+        finally:
+            # The consumer stopped early (e.g. the client disconnected): drop the pending pages
+            for pending in window:
+                pending.cancel()
+
+    async def _fetch_paged_items(self, url, params=None):
+        """
+        Fetch every item of a paginated endpoint into a list.
+        """
+        return [item async for item in self._iter_paged_items(url, params)]
+
+    @single_flight
+    @redis_cache(ttl=900)
+    async def fetch_user_top_artists(self, time_range='medium_term'):
         """
         Fetch the user's top artists.
         """
-        base_url = f'https://api.spotify.com/v1/me/top/artists?time_range={time_range}'
-        response = requests.get(base_url, headers=self.set_headers())
-        data = response.json()
-
-        self.user_top_artists = [
-            {
-                'id': artist['id'],
-                'name': artist['name'],
-                'genres': artist['genres'],
-                'popularity': artist['popularity'],
-                'followers': artist['followers']['total'],
-            }
-            for artist in data['items']
-        ]
+        base_url = 'https://api.spotify.com/v1/me/top/artists'
+        items = await self._fetch_paged_items(base_url, {'time_range': time_range})
+
+        # Columnar (one list per field) rather than one dict per artist
+        ids, names, genres, popularity, followers = [], [], [], [], []
+        for artist in items:
+            ids.append(artist['id'])
+            names.append(artist['name'])
+            genres.append(artist['genres'])
+            popularity.append(artist['popularity'])
+            followers.append(artist['followers']['total'])
+
+        self.user_top_artists = {
+            'id': ids,
+            'name': names,
+            'genres': genres,
+            'popularity': popularity,
+            'followers': followers,
+        }
+        return self.user_top_artists
 
-    def fetch_user_top_tracks(self, time_range='medium_term'):
+    @single_flight
+    @redis_cache(ttl=900)
+    async def fetch_user_top_tracks(self, time_range='medium_term'):
         """
         Fetch the user's top tracks.
         """
-        base_url = f'https://api.spotify.com/v1/me/top/tracks?time_range={time_range}'
-        response = requests.get(base_url, headers=self.set_headers())
-        data = response.json()
+        base_url = 'https://api.spotify.com/v1/me/top/tracks'
+        items = await self._fetch_paged_items(base_url, {'time_range': time_range})
 
-        self.user_top_tracks = [
-            {
-                'id': track['id'],
-                'name': track['name'],
-                'artists': [artist['name'] for artist in track['artists']],
-                'album': track['album']['name'],
-                'duration_ms': track['duration_ms']
-            }
-            for track in data['items']
-        ]
+        # Columnar (one list per field) rather than one dict per track
+        ids, names, artists, albums, durations = [], [], [], [], []
+        for track in items:
+            ids.append(track['id'])
+            names.append(track['name'])
+            artists.append([artist['name'] for artist in track['artists']])
+            albums.append(track['album']['name'])
+            durations.append(track['duration_ms'])
 
-    def fetch_user_profile(self):
+        self.user_top_tracks = {
+            'id': ids,
+            'name': names,
+            'artists': artists,
+            'album': albums,
+            'duration_ms': durations,
+        }
+        return self.user_top_tracks
+
+    @single_flight
+    @redis_cache(ttl=3600)
+    async def fetch_user_profile(self):
         """
         Fetch the user's profile information, including their profile picture.
         """
         base_url = 'https://api.spotify.com/v1/me'
-        response = requests.get(base_url, headers=self.set_headers())
-        data = response.json()
+        data = await self._get_json(base_url)
 
         self.user_profile = {
+            'id': data['id'],
             'display_name': data['display_name'],
             'profile_picture': data['images'][0]['url'] if data['images'] else None
         }
+        return self.user_profile
 
-    def fetch_playlist_details(self, playlist):
+    @staticmethod
+    def _project_playlist(playlist_data):
         """
-        Fetch detailed information for a single playlist.
+        Pick the reported fields out of a playlist object from /me/playlists.
         """
-        response = requests.get(playlist['href'], headers=self.set_headers())
-        playlist_data = response.json()
-
+        images = playlist_data['images']
         return {
             'id': playlist_data['id'],
             'name': playlist_data['name'],
             'total_tracks': playlist_data['tracks']['total'],
-            'cover_image': playlist_data['images'][0]['url'] if playlist_data['images'] else None,
+            'cover_image': images[0]['url'] if images else None,
         }
 
-    def fetch_user_playlists(self):
+    async def fetch_playlist_items(self, playlist_id):
         """
-        Fetch all playlists created by the user and their details using threading.
+        Yield every track of a playlist as its pages arrive, so callers can stream them.
+        """
+        base_url = f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
+        # Playlist pages are large and uncached by design, so they skip the ETag store too
+        async for item in self._iter_paged_items(base_url, revalidate=False):
+            # Local files and removed tracks come back with 'track' set to null
+            track = item['track']
+            if not track:
+                continue
+            yield {
+                'id': track['id'],
+                'name': track['name'],
+                'artists': [artist['name'] for artist in track['artists']],
+                'album': track['album']['name'],
+                'duration_ms': track['duration_ms'],
+                'added_at': item['added_at'],
+            }
+
+    @single_flight
+    @redis_cache(ttl=300)
+    async def fetch_user_playlists(self):
+        """
+        Fetch all playlists of the user. The listing already carries everything we report,
+        so no per-playlist detail requests are needed.
         """
         base_url = 'https://api.spotify.com/v1/me/playlists'
-        response = requests.get(base_url, headers=self.set_headers())
-        playlists_data = response.json()
-
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [executor.submit(self.fetch_playlist_details, playlist) for playlist in playlists_data['items']]
-            for future in as_completed(futures):
-                playlist_details = future.result()
-                self.user_playlists[playlist_details['name']] = playlist_details
+        items = await self._fetch_paged_items(base_url)
+
+        for playlist_data in items:
+            playlist_details = self._project_playlist(playlist_data)
+            self.user_playlists[playlist_details['name']] = playlist_details
+        return self.user_playlists
 
     def print_user_data(self):
         """